@@ -1,8 +1,14 @@
 # This file handles the main question-answering loop and API calls
 # Flow: app.py → answer_question → loop [get chunks → build prompt → call LLM → process result] → return answer
+import heapq
+import orjson
+import re
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import threading
 import time
+from collections import OrderedDict
 from dotenv import load_dotenv
 from typing import Tuple, Optional
 
@@ -12,60 +18,74 @@ from chat_engine.iteration import (
     prepare_iteration_context,
     process_iteration_result
 )
-from chat_engine.utils import remove_status_from_answer
+from chat_engine.utils import remove_status_from_answer, estimate_tokens, get_answer_status
 load_dotenv()
 
-# API key rotation variables
-current_key_index = 0
+# Token budget for one Groq request (system prompt + prompt prefix + sources + answer)
 MAX_CONTEXT_TOKENS = 4000
 TEXT_CHUNKS_PER_ITERATION = 2
 TABLE_CHUNKS_PER_ITERATION = 2
-
-# Load all available API keys
-GROQ_API_KEYS = [
-    os.getenv("GROQ_API_KEY_1"),
-    os.getenv("GROQ_API_KEY_2"),
-    os.getenv("GROQ_API_KEY_3"),
-    os.getenv("GROQ_API_KEY_4"),
-    os.getenv("GROQ_API_KEY_5"),
-    os.getenv("GROQ_API_KEY_6"),
-    os.getenv("GROQ_API_KEY_7"),
-    os.getenv("GROQ_API_KEY_8"),
-    os.getenv("GROQ_API_KEY_9"),
-    os.getenv("GROQ_API_KEY_10"),
-    os.getenv("GROQ_API_KEY_11"),
-    os.getenv("GROQ_API_KEY_12")
-]
-
-# Remove None values
-GROQ_API_KEYS = [key for key in GROQ_API_KEYS if key]
+HISTORY_PAIRS = 2
+
+# In-process cache of complete answers (see get_cached_answer)
+ANSWER_CACHE_SIZE = 256
+ANSWER_CACHE_TTL = 3600
+_ANSWER_CACHE = OrderedDict()
+_ANSWER_CACHE_LOCK = threading.Lock()
+
+# Load all available API keys (GROQ_API_KEY_1, GROQ_API_KEY_2, ... in numeric order)
+_API_KEY_RE = re.compile(r"GROQ_API_KEY_(\d+)")
+_numbered_keys = sorted(
+    (int(match.group(1)), value)
+    for name, value in os.environ.items()
+    if (match := _API_KEY_RE.fullmatch(name)) and value
+)
+GROQ_API_KEYS = [value for _, value in _numbered_keys]
 
 if not GROQ_API_KEYS:
     raise ValueError("No GROQ API keys found!")
 
 GROQ_MODEL = "llama-3.3-70b-versatile"
+GROQ_CHAT_URL = "https://api.groq.com/openai/v1/chat/completions"
+
+# Shared HTTP session → keeps the TLS connection to Groq alive between calls
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
 
-# Track when each key becomes available again (after rate limit)
-GROQ_RATE_LIMIT_UNTIL = [0] * len(GROQ_API_KEYS)
+# API key rotation variables
+# Each key is ordered by when it was last used, or until when it is rate limited.
+# The heap may hold stale entries; only the one matching _key_ready_at is valid.
+_key_ready_at = [0.0] * len(GROQ_API_KEYS)
+_key_heap = [(0.0, i) for i in range(len(GROQ_API_KEYS))]
+heapq.heapify(_key_heap)
+
+# Streamlit serves every session from its own thread, so key rotation state is shared
+_KEY_LOCK = threading.Lock()
 MAX_OUTPUT_TOKENS = 1000
 
+# The Status line is the last part of the required output format
+# While streaming, only a short tail of the answer is searched for it
+_STATUS_TAIL_CHARS = 64
+
 ###########################################################################
 # MAIN FUNCTION: Answers user question using iterative retrieval
 # Called by: app.py when user asks a question
+# Takes: recent_pairs → last (question, answer) pairs kept by app.py
 # Returns: final answer string, list of used sources
 # 
 # Flow:
 # 1. search_chunks() → gets all relevant text/table chunks from database
 # 2. compress_chat_history() → summarizes previous conversation
+#    get_cached_answer() → returns early if this exact question was answered recently
 # 3. get_system_prompt() → gets LLM instructions
 # 4. Loop (until answer complete or no chunks left):
 #    a. get_next_chunk_batch() → selects next chunks to send
 #    b. prepare_iteration_context() → builds context text
-#    c. build_user_content() → builds user prompt
+#    c. build_user_content() → stable prefix + context + question
 #    d. call_groq_model() → gets answer from LLM
 #    e. process_iteration_result() → extracts sources, checks completion
 # 5. Return final answer + sources
-def answer_question(query, chat_history=None, collection=None):
+def answer_question(query, recent_pairs=None, collection=None):
     
     if not collection:
         return "Collection is required", []
@@ -79,13 +99,31 @@ def answer_question(query, chat_history=None, collection=None):
         return "❌ No information available in the documents.", []
     
     # Step 2: Compress chat history
-    conversation_summary = compress_chat_history(chat_history, max_items=2)
+    conversation_summary = compress_chat_history(recent_pairs, max_items=HISTORY_PAIRS)
+
+    # Same question + same history + same top chunks → reuse the previous answer
+    cache_key = make_answer_cache_key(query, conversation_summary, all_text_chunks, all_table_chunks)
+    cached = get_cached_answer(cache_key)
+    if cached:
+        return cached
     
     # Step 3: Get system prompt
     system_prompt = get_system_prompt()
+
+    # Build the parts of the user prompt that stay the same across iterations
+    stable_prefix = build_stable_prefix(conversation_summary)
+    question_suffix = build_question_suffix(query)
+
+    # Sources get what is left after the fixed costs (system prompt, prefix, question, answer)
+    context_budget = max(
+        MAX_CONTEXT_TOKENS - SYSTEM_PROMPT_TOKENS - MAX_OUTPUT_TOKENS
+        - estimate_tokens(stable_prefix) - estimate_tokens(question_suffix),
+        0
+    )
     
     # Initialize iteration variables
     cumulative_cited_sources = []
+    cumulative_keys = set()
     iteration = 1
     text_index = 0
     table_index = 0
@@ -116,15 +154,11 @@ def answer_question(query, chat_history=None, collection=None):
         
         # Build context string
         context, current_iteration_chunks = prepare_iteration_context(
-            cumulative_cited_sources, new_text_batch, new_table_batch, MAX_CONTEXT_TOKENS
+            cumulative_cited_sources, new_text_batch, new_table_batch, context_budget
         )
         
         # Build user prompt
-        user_content = build_user_content(
-            conversation_summary=conversation_summary,
-            context=context,
-            query=query
-        )
+        user_content = build_user_content(stable_prefix, context, question_suffix)
 
         # Call LLM
         answer, success = call_groq_model(system_prompt, user_content)
@@ -143,6 +177,7 @@ def answer_question(query, chat_history=None, collection=None):
             answer,
             current_iteration_chunks,
             cumulative_cited_sources,
+            cumulative_keys,
             used_pages,
         )
         
@@ -152,6 +187,9 @@ def answer_question(query, chat_history=None, collection=None):
             if api_key:
                 final_answer = answer 
             final_answer = remove_status_from_answer(answer)
+            # Only cache answers the model explicitly marked complete (not cut off / unmarked)
+            if get_answer_status(answer) == "complete" and final_answer.strip():
+                cache_answer(cache_key, final_answer, cumulative_cited_sources)
             return final_answer, cumulative_cited_sources
         
         # Move to next batch (if not expanding)
@@ -165,11 +203,8 @@ def answer_question(query, chat_history=None, collection=None):
     return last_answer, cumulative_cited_sources
 
 ##############################################################
-# Returns system prompt with instructions for LLM
-# Called by: answer_question
-# Returns: system prompt string
-def get_system_prompt():
-    return """You are an accurate assistant for the Master Biomedical Engineering (MBE) program.
+# System prompt with instructions for LLM (built once at import)
+SYSTEM_PROMPT = """You are an accurate assistant for the Master Biomedical Engineering (MBE) program.
 
 GENERAL RULES:
 - Use ONLY information explicitly stated in the provided documents or conversation history.
@@ -232,47 +267,75 @@ Status:
   Complete information
 
 """
+SYSTEM_PROMPT_TOKENS = estimate_tokens(SYSTEM_PROMPT)
 
 ##############################################################
-# Builds user prompt by combining history + context + query
+# Returns system prompt with instructions for LLM
+# Called by: answer_question
+# Returns: system prompt string
+def get_system_prompt():
+    return SYSTEM_PROMPT
+
+##############################################################
+# Builds the stable head of the user prompt (conversation history)
+# Called by: answer_question once per question
+# Returns: prefix string, byte-identical for every iteration of the same question
+# Keeping it before SOURCES lets the provider's prefix cache reuse it
+def build_stable_prefix(conversation_summary):
+    return conversation_summary if conversation_summary else ""
+
+##############################################################
+# Builds the tail of the user prompt (question + output instructions)
+# Called by: answer_question once per question
+# Returns: suffix string, placed after SOURCES so the model reads the sources first
+def build_question_suffix(query):
+    return (
+        f"QUESTION: {query}\n"
+        "Answer strictly according to the system rules. Follow the required output format exactly."
+    )
+
+##############################################################
+# Builds user prompt: stable prefix + this iteration's context + question
 # Called by: answer_question before calling LLM
 # Returns: user prompt string
-def build_user_content(conversation_summary, context, query):
-    return f"""{conversation_summary if conversation_summary else ''}
-
-SOURCES:
-{context}
-QUESTION: {query}
-Answer strictly according to the system rules. Follow the required output format exactly.
-"""
+def build_user_content(stable_prefix, context, question_suffix):
+    return "\n".join((stable_prefix, "", "SOURCES:", context, question_suffix, ""))
 
 ###########################################################
 # Rotates through API keys to avoid rate limits
 # Called by: call_groq_model
 # Returns: API key (or None), key index (or wait time)
 # Logic:
-# 1. Checks if current key is available
-# 2. If rate-limited → moves to next key
-# 3. Returns first available key
+# 1. Peeks the key with the earliest ready time (least recently used)
+# 2. If it is ready → hands it out and moves it to the back of the rotation
+# 3. Otherwise all keys are rate-limited → returns wait time
 def get_next_available_key() -> Tuple[Optional[str], int]:
-    global current_key_index
-    now = time.time()
-    
-    # Try all keys
-    for _ in range(len(GROQ_API_KEYS)):
-        if now >= GROQ_RATE_LIMIT_UNTIL[current_key_index]:
-            key = GROQ_API_KEYS[current_key_index]
-            index = current_key_index
-            current_key_index = (current_key_index + 1) % len(GROQ_API_KEYS)
-            return key, index
-        
-        current_key_index = (current_key_index + 1) % len(GROQ_API_KEYS)
-    
+    with _KEY_LOCK:
+        now = time.time()
+
+        # Drop entries superseded by a later rate limit
+        while _key_heap[0][0] != _key_ready_at[_key_heap[0][1]]:
+            heapq.heappop(_key_heap)
+
+        ready_at, index = _key_heap[0]
+        if ready_at <= now:
+            _key_ready_at[index] = now
+            heapq.heapreplace(_key_heap, (now, index))
+            return GROQ_API_KEYS[index], index
+
     # All keys rate-limited → return wait time
-    earliest_available = min(GROQ_RATE_LIMIT_UNTIL)
-    wait_seconds = max(1, int(earliest_available - now))
+    wait_seconds = max(1, int(ready_at - now))
     return None, wait_seconds
 
+###########################################################
+# Marks an API key as rate limited for wait_time seconds
+# Called by: call_groq_model on 429 responses
+def mark_key_rate_limited(index: int, wait_time: int):
+    with _KEY_LOCK:
+        ready_at = time.time() + wait_time
+        _key_ready_at[index] = ready_at
+        heapq.heappush(_key_heap, (ready_at, index))
+
 #############################################################
 # Calls Groq API to get LLM response
 # Called by: answer_question in main loop
@@ -305,30 +368,32 @@ def call_groq_model(
             ],
             "temperature": temperature,
             "max_tokens": max_tokens,
+            "stream": True,
         }
 
         try:
             # Make API call
-            response = requests.post(
-                "https://api.groq.com/openai/v1/chat/completions",
+            response = _HTTP.post(
+                GROQ_CHAT_URL,
                 headers={
                     "Authorization": f"Bearer {api_key}",
                     "Content-Type": "application/json"
                 },
-                json=data,
-                timeout=60
+                data=orjson.dumps(data),
+                timeout=60,
+                stream=True
             )
 
-            response.raise_for_status()
-            answer = response.json()["choices"][0]["message"]["content"].strip()
-            return answer, True
+            with response:
+                response.raise_for_status()
+                return read_streamed_answer(response)
 
         except requests.exceptions.HTTPError as e:
             # Rate limit error → mark key as unavailable and try next
             if e.response is not None and e.response.status_code == 429:
                 retry_after = e.response.headers.get("Retry-After")
                 wait_time = int(retry_after) if retry_after else 60
-                GROQ_RATE_LIMIT_UNTIL[info] = time.time() + wait_time
+                mark_key_rate_limited(info, wait_time)
                 continue
 
             # Payload too large → return to try with fewer chunks
@@ -341,40 +406,120 @@ def call_groq_model(
             time.sleep(5)
             continue
        
+#############################################################
+# Reads a streamed (SSE) Groq response
+# Called by: call_groq_model
+# Returns: answer text, success flag (like call_groq_model)
+# Success only if the stream finished ([DONE], a finish_reason or the Status line) with a non-empty answer
+# After the Status line only [DONE] normally follows → it is read so the connection goes back to the _HTTP pool
+# If the model keeps writing after Status → stop reading and skip the generation tail
+# (this drops the connection: requests closes an unread socket instead of pooling it)
+def read_streamed_answer(response) -> Tuple[str, bool]:
+    parts = []
+    tail = ""
+    finished = False
+    status_done = False
+
+    for line in response.iter_lines():
+        if not line.startswith(b"data: "):
+            continue
+
+        payload = line[len(b"data: "):]
+        if payload == b"[DONE]":
+            finished = True
+            continue
+
+        event = orjson.loads(payload)
+        # Error sent inside the stream (after the 200 status) → fail this call
+        if "error" in event:
+            error = event["error"]
+            message = error.get("message", error) if isinstance(error, dict) else error
+            return f"API Error: {message}", False
+
+        choices = event.get("choices")
+        if choices and choices[0].get("finish_reason"):
+            finished = True
+        delta = choices[0].get("delta", {}).get("content") if choices else None
+        if not delta:
+            continue
+
+        if status_done:
+            # Trailing punctuation / whitespace is harmless; real text → abandon the stream
+            if delta.strip(" \n.*"):
+                break
+            continue
+
+        parts.append(delta)
+        tail = (tail + delta)[-_STATUS_TAIL_CHARS:]
+        if get_answer_status(tail):
+            finished = status_done = True
+
+    answer = "".join(parts).strip()
+    if not finished:
+        return "API Error: response stream ended early.", False
+    if not answer:
+        return "API Error: empty response.", False
+    return answer, True
+
+#############################################################
+# Builds the answer cache key
+# Called by: answer_question after search_chunks
+# Returns: hashable key (normalized query, history, top chunk pages)
+def make_answer_cache_key(query, conversation_summary, text_chunks, table_chunks, top_n=10):
+    top_chunks = tuple(sorted(
+        (str(chunk.source), str(chunk.page))
+        for chunk in text_chunks[:top_n] + table_chunks[:top_n]
+    ))
+    return (" ".join(query.lower().split()), conversation_summary, top_chunks)
+
+#############################################################
+# Looks up a cached complete answer
+# Called by: answer_question before the iteration loop
+# Returns: (answer, sources) or None if missing/expired
+def get_cached_answer(key):
+    with _ANSWER_CACHE_LOCK:
+        entry = _ANSWER_CACHE.get(key)
+        if entry is None:
+            return None
+
+        stored_at, answer, sources = entry
+        if time.time() - stored_at > ANSWER_CACHE_TTL:
+            del _ANSWER_CACHE[key]
+            return None
+
+        _ANSWER_CACHE.move_to_end(key)
+        return answer, list(sources)
+
+#############################################################
+# Stores a complete answer (oldest entries are evicted first)
+# Called by: answer_question when the answer is complete
+def cache_answer(key, answer, sources):
+    with _ANSWER_CACHE_LOCK:
+        _ANSWER_CACHE[key] = (time.time(), answer, list(sources))
+        _ANSWER_CACHE.move_to_end(key)
+        while len(_ANSWER_CACHE) > ANSWER_CACHE_SIZE:
+            _ANSWER_CACHE.popitem(last=False)
+
 #############################################################
 # Summarizes recent chat history for context
 # Called by: answer_question at start
 # Returns: conversation summary string
 # Takes last N user-assistant pairs and formats them
-def compress_chat_history(chat_history, max_items=2):
-    if not chat_history:
+# app.py keeps them in a bounded deque, so no history scan is needed
+def compress_chat_history(recent_pairs, max_items=HISTORY_PAIRS):
+    if not recent_pairs:
         return ""
-    
-    recent_pairs = []
-    
-    # Extract last N question-answer pairs
-    for i in range(len(chat_history) - 1, -1, -1):
-        if chat_history[i]["role"] == "user":
-            user_msg = chat_history[i]["content"]
-            if i + 1 < len(chat_history) and chat_history[i + 1]["role"] == "assistant":
-                assistant_msg = chat_history[i + 1]["content"]
-                recent_pairs.insert(0, (user_msg, assistant_msg))
-                if len(recent_pairs) >= max_items:
-                    break
-    
+
     # Format pairs
-    if recent_pairs:
-        summary = ["=== Previous Conversation ==="]
-        for idx, (q, a) in enumerate(recent_pairs, 1):
-            summary.append(f"\nQ{idx}: {q}")
-            # Truncate long answers
-            if len(a) > 300:
-                summary.append(f"A{idx}: {a[:300]}...")
-            else:
-                summary.append(f"A{idx}: {a}")
-        summary.append("\n=== End ===\n")
-        return "\n".join(summary)
-    
-    return ""
+    summary = ["=== Previous Conversation ==="]
+    for idx, (q, a) in enumerate(list(recent_pairs)[-max_items:], 1):
+        summary.append(f"\nQ{idx}: {q}")
+        # Truncate long answers
+        if len(a) > 300:
+            summary.append(f"A{idx}: {a[:300]}...")
+        else:
+            summary.append(f"A{idx}: {a}")
+    summary.append("\n=== End ===\n")
+    return "\n".join(summary)
 
 #############################################################
\ No newline at end of file
@@ -3,13 +3,17 @@
 
 import streamlit as st
 import uuid
+from collections import deque
 import chromadb
 import os
 import re
 import time
 from styles import load_custom_css
 from chromadb.utils import embedding_functions
-from API import answer_question
+from API import answer_question, HISTORY_PAIRS
+
+# Rate limit message from API.call_groq_model
+_WAIT_RE = re.compile(r'wait (\d+) seconds', re.IGNORECASE)
 
 # Configure Streamlit page
 st.set_page_config(
@@ -28,10 +32,15 @@ CHROMA_FOLDER = "./chroma_db"
 os.makedirs(CHROMA_FOLDER, exist_ok=True)
 
 # Get embedding function for ChromaDB
+# Cached → the SentenceTransformer model is loaded once per process, not per rerun
+# Warmed up with a dummy input so the first user query doesn't pay the cold start
+@st.cache_resource
 def get_embedding_function():
-    return embedding_functions.SentenceTransformerEmbeddingFunction(
+    embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
         model_name="intfloat/multilingual-e5-large"
     )
+    embedding_function(["warmup"])
+    return embedding_function
 
 # Initialize session state
 if "collection" not in st.session_state:
@@ -39,26 +48,36 @@ if "collection" not in st.session_state:
 if "chats" not in st.session_state:
     st.session_state.chats = {}
     st.session_state.active_chat = None
+if "rate_limited_until" not in st.session_state:
+    st.session_state.rate_limited_until = 0
 
 ###########################################################################
 # LOAD EXISTING CHROMADB
 ###########################################################################
 
-try:
+# Opens the first ChromaDB collection (or None if there is none)
+# Cached → the client is created once per process instead of on every rerun
+@st.cache_resource
+def get_collection():
     client = chromadb.PersistentClient(path=CHROMA_FOLDER)
     collections = client.list_collections()
-    
-    if collections:
-        # Load existing collection
-        collection = client.get_collection(
-            name=collections[0].name,
-            embedding_function=get_embedding_function()
-        )
+
+    if not collections:
+        return None
+
+    return client.get_collection(
+        name=collections[0].name,
+        embedding_function=get_embedding_function()
+    )
+
+try:
+    collection = get_collection()
+
+    if collection is not None:
         st.session_state.collection = collection
-        
-        # Get collection info
-        collection_count = collection.count()
     else:
+        # Don't keep the empty result → pick up the database once it exists
+        get_collection.clear()
         st.error("❌ No ChromaDB collection found! Please run the document processing first.")
         st.info("💡 Make sure you have a ChromaDB in the './chroma_db' folder")
         st.stop()
@@ -78,6 +97,7 @@ if not st.session_state.chats:
     st.session_state.chats[cid] = {
         "title": "New Chat",
         "messages": [],
+        "recent_pairs": deque(maxlen=HISTORY_PAIRS),
         "context": []
     }
     st.session_state.active_chat = cid
@@ -111,6 +131,7 @@ with st.sidebar:
         st.session_state.chats[cid] = {
             "title": "New Chat",
             "messages": [],
+            "recent_pairs": deque(maxlen=HISTORY_PAIRS),
             "context": []
         }
         st.session_state.active_chat = cid
@@ -141,13 +162,29 @@ with st.sidebar:
 # MAIN CHAT AREA
 ###########################################################################
 
+# Display chat history
+def render_history(messages):
+    for m in messages:
+        with st.chat_message(m["role"]):
+            st.markdown(m["content"])
+
+# Rate limit countdown
+# Fragment re-runs itself every second → no blocking sleep, the UI stays usable
+# At the deadline → clear the timer and rerun the app so the fragment stops ticking
+@st.fragment(run_every=1)
+def render_rate_limit_countdown():
+    remaining = int(st.session_state.rate_limited_until - time.time())
+    if remaining > 0:
+        st.warning(f"⏳ Please wait {remaining} seconds before sending a new request...")
+    else:
+        st.session_state.rate_limited_until = 0
+        st.session_state.rate_limit_cleared = True
+        st.rerun()
+
 # Get current chat
 chat = st.session_state.chats[st.session_state.active_chat]
 
-# Display chat history
-for m in chat["messages"]:
-    with st.chat_message(m["role"]):
-        st.markdown(m["content"])
+render_history(chat["messages"])
 
 # Chat input
 if query := st.chat_input("Ask anything about the MBE program documents..."):
@@ -168,23 +205,26 @@ if query := st.chat_input("Ask anything about the MBE program documents..."):
             # Call answer function
             answer, used_chunks = answer_question(
                 query,
-                chat["messages"],
+                chat["recent_pairs"],
                 collection=st.session_state.collection
             )
             
             st.markdown(answer, unsafe_allow_html=True)
             
-            # Handle rate limit countdown
-            match = re.search(r'wait (\d+) seconds', answer.lower())
+            # Handle rate limit countdown (shown below the chat)
+            match = _WAIT_RE.search(answer)
             if match:
-                remaining = int(match.group(1))
-                countdown = st.empty()
-                while remaining > 0:
-                    countdown.warning(f"⏳ Please wait {remaining} seconds before sending a new request...")
-                    time.sleep(1)
-                    remaining -= 1
-                countdown.success("✅ You can now send a new question.")
+                st.session_state.rate_limited_until = time.time() + int(match.group(1))
+            else:
+                st.session_state.rate_limited_until = 0
     
     # Add assistant message
     chat["messages"].append({"role": "assistant", "content": answer})
+    chat["recent_pairs"].append((query, answer))
     chat["context"] = used_chunks if used_chunks else []
+
+# Show rate limit countdown
+if st.session_state.rate_limited_until:
+    render_rate_limit_countdown()
+elif st.session_state.pop("rate_limit_cleared", False):
+    st.toast("✅ You can now send a new question.")
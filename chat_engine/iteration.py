@@ -5,8 +5,7 @@ from typing import Tuple
 
 from .retrieval import get_surrounding_pages_smart
 from .utils import (
-    check_if_answer_incomplete,
-    check_if_answer_insufficient,
+    classify_answer,
     extract_used_sources_from_answer,
     estimate_tokens
 )
@@ -16,6 +15,14 @@ MAX_CONTEXT_TOKENS = 4000
 TEXT_CHUNKS_PER_ITERATION = 6
 TABLE_CHUNKS_PER_ITERATION = 4
 
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+# Rough token cost of a "[📄 NEW source pX]" header line
+PART_HEADER_TOKENS = 10
+
+# Chunk types that hold tables
+_TABLE_TYPES = frozenset({"table", "table_with_context"})
+_TYPE_MARKER = {True: "[TABLE]", False: "[TEXT]"}
+
 ################################################################################
 # Decides which chunks to send to LLM in this iteration
 # Called by: API.answer_question in main loop
@@ -44,7 +51,7 @@ def get_next_chunk_batch(
         return new_text_batch, new_table_batch, False
     
     # Check if last answer was incomplete
-    is_incomplete = check_if_answer_incomplete(last_answer)
+    is_incomplete, _ = classify_answer(last_answer)
 
     # If incomplete → get surrounding pages of cited sources
     if is_incomplete and cumulative_cited_sources:
@@ -52,11 +59,12 @@ def get_next_chunk_batch(
         BASE_SURROUNDING_RANGE = 1
         MAX_SURROUNDING_RANGE = 4
 
-        expanded_chunks = []
+        chunks_to_expand = []
+        source_ranges = {}
 
-        # For each cited source, get nearby pages
+        # For each cited source, pick how far to expand
         for chunk in cumulative_cited_sources:
-            source = chunk.get("source")
+            source = chunk.source
             if not source or source in seen_sources:
                 continue
             seen_sources.add(source)
@@ -73,35 +81,34 @@ def get_next_chunk_batch(
                 MAX_SURROUNDING_RANGE
             )
 
-            # Get surrounding pages from database
-            surrounding = get_surrounding_pages_smart(
-                collection,
-                [chunk],
-                pages_range=dynamic_range
-            )
+            chunks_to_expand.append(chunk)
+            source_ranges[source] = dynamic_range
+
+        # Get surrounding pages of all sources from database (queried in parallel)
+        expanded_chunks = get_surrounding_pages_smart(
+            collection,
+            chunks_to_expand,
+            source_ranges=source_ranges
+        )
 
-            if surrounding:
-                source_expansion_steps[source] = current_step + 1
-                expanded_chunks.extend(surrounding)
+        # Widen the range next time for sources that returned pages
+        for source in {ch.source for ch in expanded_chunks}:
+            if source in source_ranges:
+                source_expansion_steps[source] += 1
 
-        # Filter out already used pages
-        filtered_chunks = []
+        # Filter out already used pages and separate text and tables in one pass
+        new_text_batch = []
+        new_table_batch = []
         for ch in expanded_chunks:
-            key = f"{ch.get('source')}_{ch.get('page')}"
-            if key not in used_pages:
-                used_pages.add(key)
-                filtered_chunks.append(ch)
-
-        # Separate text and tables
-        new_text_batch = [
-            c for c in filtered_chunks
-            if c.get("type") not in ["table", "table_with_context"]
-        ]
-
-        new_table_batch = [
-            c for c in filtered_chunks
-            if c.get("type") in ["table", "table_with_context"]
-        ]
+            key = (ch.source, ch.page)
+            if key in used_pages:
+                continue
+            used_pages.add(key)
+
+            if ch.type in _TABLE_TYPES:
+                new_table_batch.append(ch)
+            else:
+                new_text_batch.append(ch)
 
         if new_text_batch or new_table_batch:
             return new_text_batch, new_table_batch, True
@@ -116,13 +123,13 @@ def get_next_chunk_batch(
     
     candidate_text = all_text_chunks[text_index:text_index + TEXT_CHUNKS_PER_ITERATION]
     for chunk in candidate_text:
-        key = f"{chunk.get('source')}_{chunk.get('page')}"
+        key = (chunk.source, chunk.page)
         if key not in used_pages:
             new_text_batch.append(chunk)
     
     candidate_tables = all_table_chunks[table_index:table_index + TABLE_CHUNKS_PER_ITERATION]
     for chunk in candidate_tables:
-        key = f"{chunk.get('source')}_{chunk.get('page')}"
+        key = (chunk.source, chunk.page)
         if key not in used_pages:
             new_table_batch.append(chunk)
     
@@ -135,8 +142,8 @@ def get_next_chunk_batch(
 # Logic:
 # 1. Add previously cited sources (last 6)
 # 2. Add new table chunks
-# 3. Add new text chunks
-# 4. Trim if total exceeds max tokens
+# 3. Add new text chunks until the token budget is full
+# 4. Join once, trimming only if total exceeds max tokens
 def prepare_iteration_context(
     cumulative_cited_sources: list,
     new_text_batch: list,
@@ -146,63 +153,79 @@ def prepare_iteration_context(
 ) -> Tuple[str, list]:
 
     context_parts = []
+    part_tokens = []
     current_iteration_chunks = []
     seen_keys = set()
+    separator_tokens = estimate_tokens(CONTEXT_SEPARATOR)
 
     # Add previously used sources (for context)
     if cumulative_cited_sources:
         used_sources_limited = cumulative_cited_sources[-max_used_sources:]
 
         for chunk in used_sources_limited:
-            source = chunk.get("source", "Unknown")
-            page = chunk.get("page", "N/A")
-            content = chunk.get("content", "")
-            chunk_type = chunk.get("type", "text")
+            source = chunk.source
+            page = chunk.page
 
-            key = f"{source}_{page}"
+            key = (source, page)
             if key in seen_keys:
                 continue
             seen_keys.add(key)
 
             # Mark as "USED" so LLM knows it saw this before
-            type_marker = "[TABLE]" if chunk_type in ["table", "table_with_context"] else "[TEXT]"
+            type_marker = _TYPE_MARKER[chunk.type in _TABLE_TYPES]
             context_parts.append(
-                f"[📌 USED {type_marker} {source} p{page}]\n{content}"
+                f"[📌 USED {type_marker} {source} p{page}]\n{chunk.content}"
             )
+            part_tokens.append(chunk.tokens + PART_HEADER_TOKENS)
             current_iteration_chunks.append(chunk)
 
     # Add new tables (priority over text)
     for chunk in new_table_batch:
-        source = chunk.get("source", "Unknown")
-        page = chunk.get("page", "N/A")
-        key = f"{source}_{page}"
+        source = chunk.source
+        page = chunk.page
+        key = (source, page)
 
         if key in seen_keys:
             continue
         seen_keys.add(key)
 
         context_parts.append(
-            f"[📊 NEW {source} p{page}]\n{chunk.get('content', '')}"
+            f"[📊 NEW {source} p{page}]\n{chunk.content}"
         )
+        part_tokens.append(chunk.tokens + PART_HEADER_TOKENS)
         current_iteration_chunks.append(chunk)
 
-    # Add new text chunks
+    # Add new text chunks (stop once the budget is full → the rest would be trimmed)
+    total_tokens = sum(part_tokens) + separator_tokens * max(len(part_tokens) - 1, 0)
     for chunk in new_text_batch:
-        source = chunk.get("source", "Unknown")
-        page = chunk.get("page", "N/A")
-        key = f"{source}_{page}"
+        source = chunk.source
+        page = chunk.page
+        key = (source, page)
 
         if key in seen_keys:
             continue
+
+        chunk_tokens = chunk.tokens + PART_HEADER_TOKENS
+        added_tokens = chunk_tokens + (separator_tokens if context_parts else 0)
+        if context_parts and total_tokens + added_tokens > max_tokens:
+            break
+        total_tokens += added_tokens
         seen_keys.add(key)
 
         context_parts.append(
-            f"[📄 NEW {source} p{page}]\n{chunk.get('content', '')}"
+            f"[📄 NEW {source} p{page}]\n{chunk.content}"
         )
+        part_tokens.append(chunk_tokens)
         current_iteration_chunks.append(chunk)
 
-    # Trim if too long
-    context = trim_context_to_fit(context_parts, max_tokens)
+    # Under budget (common case) → single join; trim only on overflow
+    # (only USED sources and tables can still overflow)
+    if total_tokens <= max_tokens:
+        context = CONTEXT_SEPARATOR.join(context_parts)
+    else:
+        context = trim_context_to_fit(
+            context_parts, part_tokens, separator_tokens, max_tokens
+        )
 
     return context, current_iteration_chunks
 
@@ -213,18 +236,18 @@ def prepare_iteration_context(
 # Logic:
 # 1. Check if answer is insufficient (no info found)
 # 2. If sufficient → extract cited sources from answer
-# 3. Add new sources to cumulative list (avoid duplicates)
+# 3. Add new sources to cumulative list in place (cumulative_keys avoids duplicates)
 # 4. Check if answer is complete
 def process_iteration_result(
     answer: str,
     current_iteration_chunks: list,
     cumulative_cited_sources: list,
+    cumulative_keys: set,
     used_pages: set,
 ) -> Tuple[list, bool]:
     
     # Check answer quality
-    is_insufficient = check_if_answer_insufficient(answer)
-    is_incomplete = check_if_answer_incomplete(answer)
+    is_incomplete, is_insufficient = classify_answer(answer)
     
     # If no info found → don't extract sources
     if is_insufficient:
@@ -235,21 +258,15 @@ def process_iteration_result(
             answer, current_iteration_chunks
         )
 
-    # Add new cited sources to cumulative list
-    updated_cumulative = cumulative_cited_sources.copy()
+    # Add new cited sources to cumulative list (avoid duplicates by source + page)
     for new_source in cited_in_this_iteration:
-        # Check if already in list
-        is_duplicate = False
-        for existing in updated_cumulative:
-            if (existing.get("source") == new_source.get("source") and 
-                existing.get("page") == new_source.get("page")):
-                is_duplicate = True
-                break
-        
-        if not is_duplicate:
-            updated_cumulative.append(new_source)
-            key = f"{new_source.get('source')}_{new_source.get('page')}"
-            used_pages.add(key)
+        source_key = (new_source.source, new_source.page)
+        if source_key in cumulative_keys:
+            continue
+
+        cumulative_keys.add(source_key)
+        cumulative_cited_sources.append(new_source)
+        used_pages.add(source_key)
 
     # Answer is complete if it has info and is not partial
     is_complete = (
@@ -257,26 +274,27 @@ def process_iteration_result(
         (not is_incomplete)
     )
     
-    return updated_cumulative, is_complete
+    return cumulative_cited_sources, is_complete
 
 ################################################################################
 # Trims context to fit within token limit
 # Called by: prepare_iteration_context
 # Returns: trimmed context string
 # Logic: If too long → remove chunks from end until it fits
-def trim_context_to_fit(context_parts: list, max_tokens: int = MAX_CONTEXT_TOKENS) -> str:
-    total_text = "\n\n---\n\n".join(context_parts)
-    current_tokens = estimate_tokens(total_text)
-    
-    if current_tokens <= max_tokens:
-        return total_text
-    
+# Uses the per-part token counts from the caller as a running total
+def trim_context_to_fit(
+    context_parts: list,
+    part_tokens: list,
+    separator_tokens: int,
+    max_tokens: int = MAX_CONTEXT_TOKENS
+) -> str:
+    current_tokens = sum(part_tokens) + separator_tokens * max(len(context_parts) - 1, 0)
+
     # Remove chunks from end until fits
     while current_tokens > max_tokens and len(context_parts) > 1:
         context_parts.pop()
-        total_text = "\n\n---\n\n".join(context_parts)
-        current_tokens = estimate_tokens(total_text)
-    
-    return total_text
+        current_tokens -= part_tokens.pop() + separator_tokens
+
+    return CONTEXT_SEPARATOR.join(context_parts)
 
 ################################################################################
\ No newline at end of file
@@ -2,32 +2,63 @@
 # Flow: API.py → search_chunks → returns text and table chunks
 #       iteration.py → get_surrounding_pages_smart → returns nearby pages
 
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 MIN_CHUNK_TOKENS = 200
-from .utils import estimate_tokens
+# Average number of chunks fetched per surrounding page (limit is shared by the batch)
+CHUNKS_PER_PAGE = 2
+from .utils import Chunk, estimate_tokens
+
+# Share of text results that pass the MIN_CHUNK_TOKENS filter (moving average)
+# Used to over-fetch text results so that about n_text survive the filter
+_text_keep_rate = 1.0
+KEEP_RATE_SMOOTHING = 0.3
+MIN_KEEP_RATE = 0.25
+_KEEP_RATE_LOCK = threading.Lock()
+
+# Cache of page lookups: (collection, source, page) → chunks on that page
+PAGE_CACHE_SIZE = 1024
+_PAGE_CACHE = OrderedDict()
+_PAGE_CACHE_LOCK = threading.Lock()
 
 ################################################################################
 # Main search function → queries database for relevant chunks
 # Called by: API.answer_question at the start
 # Returns: text chunks list, table chunks list
 # Flow:
-# 1. Searches for table chunks (max 40)
-# 2. Searches for text chunks (max 80)
+# 1. Embeds the query once (or uses query_embedding if given)
+# 2. Searches for table chunks (max 40) and text chunks (max 80) concurrently
 # 3. Filters out chunks that are too small (< 200 tokens)
-def search_chunks(collection, query: str, n_text: int = 80, n_tables: int = 40):
+#    → text search over-fetches by the observed keep rate, then keeps at most n_text
+def search_chunks(collection, query: str, n_text: int = 80, n_tables: int = 40, query_embedding=None):
     text_chunks = []
     table_chunks = []
 
+    # Both queries share one embedding instead of embedding the query twice
+    if query_embedding is None:
+        query_embedding = embed_query(collection, query)
+
+    if query_embedding is not None:
+        query_input = {"query_embeddings": [query_embedding]}
+    else:
+        query_input = {"query_texts": [query]}
+
     # Define two separate queries
     queries = [
         {
             "n_results": n_tables,
+            "max_results": n_tables,
             "where": {"type": {"$in": ["table_with_context", "table"]}},
             "target": table_chunks,
             "min_tokens": None,  # Don't filter tables by size
             "default_type": "table"
         },
         {
-            "n_results": n_text,
+            "n_results": math.ceil(n_text / max(_text_keep_rate, MIN_KEEP_RATE)),
+            "max_results": n_text,
             "where": {"type": {"$nin": ["table_with_context", "table"]}},
             "target": text_chunks,
             "min_tokens": MIN_CHUNK_TOKENS,  # Filter small text chunks
@@ -35,70 +66,111 @@ def search_chunks(collection, query: str, n_text: int = 80, n_tables: int = 40):
         }
     ]
 
-    # Run both queries
-    for q in queries:
-        try:
-            # Query ChromaDB collection
-            results = collection.query(
-                query_texts=[query],
+    # Run both queries (independent → in parallel)
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        futures = [
+            executor.submit(
+                collection.query,
+                **query_input,
                 n_results=q["n_results"],
                 where=q["where"]
             )
+            for q in queries
+        ]
+
+    for q, future in zip(queries, futures):
+        try:
+            results = future.result()
 
             # Process results
+            processed = 0
             for doc, meta in zip(results["documents"][0], results["metadatas"][0]):
+                if len(q["target"]) >= q["max_results"]:
+                    break
+                processed += 1
+
+                chunk = make_chunk(doc, meta, q["default_type"])
+
                 # Skip small text chunks
-                if q["min_tokens"] and estimate_tokens(doc) < q["min_tokens"]:
+                if q["min_tokens"] and chunk.tokens < q["min_tokens"]:
                     continue
 
                 # Add to target list
-                q["target"].append({
-                    "content": doc,
-                    "metadata": meta,
-                    "source": meta.get("source", "Unknown"),
-                    "page": meta.get("page", "N/A"),
-                    "type": meta.get("type", q["default_type"])
-                })
+                q["target"].append(chunk)
+
+            # Remember how many text results survived the size filter
+            if q["min_tokens"] and processed:
+                update_text_keep_rate(len(q["target"]) / processed)
         except Exception:
             pass
 
     return text_chunks, table_chunks
 
+################################################################################
+# Updates the moving average of text results kept by the size filter
+# Called by: search_chunks after the text search
+def update_text_keep_rate(keep_rate: float):
+    global _text_keep_rate
+    with _KEEP_RATE_LOCK:
+        _text_keep_rate += KEEP_RATE_SMOOTHING * (keep_rate - _text_keep_rate)
+
+################################################################################
+# Builds one chunk record from a database result
+# Called by: search_chunks and get_surrounding_pages_smart
+# Returns: Chunk (token estimate is computed once and stored as tokens)
+def make_chunk(doc: str, meta: dict, default_type: str) -> Chunk:
+    return Chunk(
+        content=doc,
+        source=meta.get("source", "Unknown"),
+        page=meta.get("page", "N/A"),
+        type=meta.get("type", default_type),
+        metadata=meta,
+        tokens=estimate_tokens(doc)
+    )
+
+################################################################################
+# Embeds a query with the collection's embedding function
+# Called by: search_chunks
+# Returns: embedding vector, or None if the collection has no embedding function
+def embed_query(collection, query: str):
+    embedding_function = getattr(collection, "_embedding_function", None)
+    if embedding_function is None:
+        return None
+
+    try:
+        return embedding_function([query])[0]
+    except Exception:
+        return None
+
 ################################################################################
 # Gets pages surrounding cited chunks (pages before and after)
 # Called by: iteration.get_next_chunk_batch when answer is incomplete
 # Returns: list of surrounding chunks
 # Logic:
 # 1. For each cited chunk
-# 2. Get pages N before and N after (N = pages_range)
+# 2. Collect pages N before and N after (N = pages_range, or source_ranges[source]),
+#    grouped by source
 # 3. Avoids duplicates using seen set
-def get_surrounding_pages_smart(collection, cited_chunks: list, pages_range: int = 1) -> list:
+# 4. Fetches all target pages of a source with one database call (see fetch_pages),
+#    different sources in parallel
+def get_surrounding_pages_smart(
+    collection,
+    cited_chunks: list,
+    pages_range: int = 1,
+    source_ranges: dict = None
+) -> list:
     surrounding_chunks = []
     seen = set()
+    target_pages_by_source = {}
     
     for chunk in cited_chunks:
-        source = chunk.get("source", "")
-        page = chunk.get("page", "")
-        
-        # Handle merged pages (e.g., "3-5")
-        if isinstance(page, str) and "-" in str(page):
-            try:
-                pages = [int(p) for p in str(page).split("-")]
-                current_pages = list(range(pages[0], pages[-1] + 1))
-            except:
-                try:
-                    current_pages = [int(page)]
-                except:
-                    continue
-        else:
-            try:
-                current_pages = [int(page)]
-            except:
-                continue
+        source = chunk.source
+        current_pages = parse_pages(chunk.page)
+        chunk_range = source_ranges.get(source, pages_range) if source_ranges else pages_range
         
-        # For each current page, get surrounding pages
+        # For each current page, collect surrounding pages
         for current_page in current_pages:
-            for offset in range(-pages_range, pages_range + 1):
+            for offset in range(-chunk_range, chunk_range + 1):
                 # Skip the current page itself
                 if offset == 0:
                     continue
@@ -109,38 +181,109 @@ def get_surrounding_pages_smart(collection, cited_chunks: list, pages_range: int
                 if target_page < 1:
                     continue
                 
-                # Skip if already retrieved
-                key = f"{source}_{target_page}"
+                # Skip if already collected
+                key = (source, target_page)
                 if key in seen:
                     continue
                 seen.add(key)
-                
-                # Query database for this specific page
-                try:
-                    results = collection.query(
-                        query_texts=["context retrieval"],
-                        n_results=5,
-                        where={
-                            "$and": [
-                                {"source": source},
-                                {"page": target_page}
-                            ]
-                        }
-                    )
-                    
-                    # Add results
-                    if results["documents"][0]:
-                        for doc, meta in zip(results["documents"][0], results["metadatas"][0]):
-                            surrounding_chunks.append({
-                                "content": doc,
-                                "metadata": meta,
-                                "source": meta.get("source", "Unknown"),
-                                "page": meta.get("page", "N/A"),
-                                "type": meta.get("type", "text")
-                            })
-                except Exception as e:
-                    continue
+
+                target_pages_by_source.setdefault(source, []).append(target_page)
+
+    if not target_pages_by_source:
+        return surrounding_chunks
+
+    # Query database once per source for all its target pages (sources in parallel)
+    tasks = list(target_pages_by_source.items())
+    with ThreadPoolExecutor(max_workers=min(8, len(tasks))) as executor:
+        futures = [
+            executor.submit(fetch_pages, collection, source, target_pages)
+            for source, target_pages in tasks
+        ]
+
+    for (source, target_pages), future in zip(tasks, futures):
+        try:
+            chunks_by_page = future.result()
+        except Exception as e:
+            continue
+
+        # Add results
+        for target_page in target_pages:
+            surrounding_chunks.extend(chunks_by_page.get(target_page, []))
     
     return surrounding_chunks
 
+################################################################################
+# Parses a chunk's page value into page numbers
+# Called by: get_surrounding_pages_smart
+# Returns: list of ints ([] if the page is unknown)
+# Handles plain pages (3 or "3") and merged pages ("3-5")
+def parse_pages(page) -> list:
+    if isinstance(page, int):
+        return [page]
+
+    if isinstance(page, str):
+        if "-" in page:
+            first, _, last = page.partition("-")
+            if first.isdigit() and last.isdigit():
+                return list(range(int(first), int(last) + 1))
+        if page.isdigit():
+            return [int(page)]
+
+    return []
+
+################################################################################
+# Fetches all chunks on the given pages of one source
+# Called by: get_surrounding_pages_smart
+# Returns: dict page → list of chunks
+# Logic:
+# 1. Takes pages already fetched (e.g. in an earlier expansion step) from the cache
+# 2. Fetches the missing pages with one $in lookup and caches them
+def fetch_pages(collection, source: str, pages: list) -> dict:
+    collection_key = getattr(collection, "id", None) or id(collection)
+    chunks_by_page = {}
+    missing_pages = []
+
+    with _PAGE_CACHE_LOCK:
+        for page in pages:
+            cache_key = (collection_key, source, page)
+            if cache_key in _PAGE_CACHE:
+                _PAGE_CACHE.move_to_end(cache_key)
+                chunks_by_page[page] = _PAGE_CACHE[cache_key]
+            else:
+                missing_pages.append(page)
+
+    if not missing_pages:
+        return chunks_by_page
+
+    # One row over the expected count tells a cut-off result from an exactly full one
+    limit = CHUNKS_PER_PAGE * len(missing_pages) + 1
+    results = collection.get(
+        where={
+            "$and": [
+                {"source": source},
+                {"page": {"$in": missing_pages}}
+            ]
+        },
+        limit=limit
+    )
+
+    fetched = {page: [] for page in missing_pages}
+    for doc, meta in zip(results["documents"], results["metadatas"]):
+        fetched.setdefault(meta.get("page"), []).append(make_chunk(doc, meta, "text"))
+    chunks_by_page.update(fetched)
+
+    # A full result may be cut off on any page (results are not ordered by page)
+    # → cache nothing, so a partial page is fetched again next time
+    if len(results["documents"]) >= limit:
+        return chunks_by_page
+
+    with _PAGE_CACHE_LOCK:
+        for page in missing_pages:
+            _PAGE_CACHE[(collection_key, source, page)] = fetched[page]
+            _PAGE_CACHE.move_to_end((collection_key, source, page))
+        while len(_PAGE_CACHE) > PAGE_CACHE_SIZE:
+            _PAGE_CACHE.popitem(last=False)
+
+    return chunks_by_page
+
 ################################################################################
\ No newline at end of file
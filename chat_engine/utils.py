@@ -2,35 +2,62 @@
 # Used by: iteration.py and API.py
 
 import re
+from dataclasses import dataclass
+
+# Precompiled patterns for parsing LLM answers
+_SOURCES_RE = re.compile(r"Sources:\s*(.*)", re.DOTALL | re.IGNORECASE)
+_STATUS_RE = re.compile(r"^status:\s*.*$", re.IGNORECASE | re.MULTILINE)
+# Any non-letters (spaces, "*", "-", "–", "•", "1.", newlines) may sit between "Status:" and the value
+# Shared by classify_answer and API.read_streamed_answer so both agree on what a Status line is
+_STATUS_VALUE_RE = re.compile(r"status:[^a-z]*(complete|partial|no) information", re.IGNORECASE)
+_NO_INFO_RE = re.compile(r"❌\s*no sufficient information found", re.IGNORECASE)
+# Shortest answer that can cite anything: "Sources: " plus one character
+_MIN_CITING_ANSWER_LEN = len("Sources: ") + 1
 
 ################################################################################
-# Checks if LLM answer says "partial information"
-# Called by: iteration.get_next_chunk_batch and iteration.process_iteration_result
-# Returns: True if incomplete, False otherwise
-# Used to decide if we need more context
-def check_if_answer_incomplete(answer: str) -> bool:
-    answer_lower = answer.lower()
-    
-    if "status:" in answer_lower and "partial information" in answer_lower:
-        return True
-
-    return False
+# One retrieved chunk (built by retrieval.make_chunk)
+# Used by: retrieval.py, iteration.py, API.py
+# tokens → content token estimate, computed once when the chunk is built
+@dataclass(slots=True)
+class Chunk:
+    content: str
+    source: str
+    page: object
+    type: str
+    metadata: dict
+    tokens: int = 0
 
 ################################################################################
-# Checks if LLM answer says "no information found"
-# Called by: iteration.process_iteration_result
-# Returns: True if insufficient, False otherwise
-# Used to decide if we should extract sources from this answer
-def check_if_answer_insufficient(answer: str) -> bool:
-    answer_lower = answer.lower()
+# Checks the answer status in a single pass
+# Called by: iteration.get_next_chunk_batch and iteration.process_iteration_result
+# Returns: (is_incomplete, is_insufficient)
+# - incomplete → status is "Partial information" → we need more context
+# - insufficient → status is "No information" (or no info found) → don't extract sources
+def classify_answer(answer: str) -> tuple:
+    is_incomplete = False
+    is_insufficient = False
+
+    for match in _STATUS_VALUE_RE.finditer(answer):
+        status = match.group(1).lower()
+        if status == "partial":
+            is_incomplete = True
+        elif status == "no":
+            is_insufficient = True
 
-    if "❌ no sufficient information found" in answer_lower:
-        return True
+    if _NO_INFO_RE.search(answer):
+        is_insufficient = True
 
-    if "status:" in answer_lower and "no information" in answer_lower:
-        return True
+    return is_incomplete, is_insufficient
 
-    return False
+################################################################################
+# Reads the status value of an answer
+# Called by: API.read_streamed_answer (stream stop) and API.answer_question (caching)
+# Returns: "complete", "partial", "no" (last Status line wins), or None if there is none
+def get_answer_status(answer: str):
+    status = None
+    for match in _STATUS_VALUE_RE.finditer(answer):
+        status = match.group(1).lower()
+    return status
 
 ################################################################################
 # Extracts which sources were actually used in the answer
@@ -41,13 +68,18 @@ def check_if_answer_insufficient(answer: str) -> bool:
 # 2. Parses source names and page numbers
 # 3. Matches them against used_chunks to get full chunk data
 def extract_used_sources_from_answer(answer: str, used_chunks: list) -> list:
+    # Nothing to match against, or too short to hold a Sources section
+    if not used_chunks or len(answer) < _MIN_CITING_ANSWER_LEN:
+        return []
+
     actually_used = []
 
     # Find Sources section
-    match = re.search(r"Sources:\s*(.*)", answer, re.DOTALL | re.IGNORECASE)
+    match = _SOURCES_RE.search(answer)
     if not match:
         return []
 
+    # Lowercase only the Sources section, not the whole answer
     sources_text = match.group(1).lower()
 
     # Parse each line in Sources section
@@ -57,25 +89,32 @@ def extract_used_sources_from_answer(answer: str, used_chunks: list) -> list:
         if line.strip()
     ]
 
+    # Lines that mention each source name (filled lazily, shared by chunks of one source)
+    lines_by_source = {}
+
     # Match each chunk against cited sources
     for chunk in used_chunks:
-        if not isinstance(chunk, dict):
+        if not isinstance(chunk, Chunk):
             continue
 
-        source = chunk.get("source") or chunk.get("metadata", {}).get("source", "")
-        page = chunk.get("page") or chunk.get("metadata", {}).get("page", "")
+        source = chunk.source or chunk.metadata.get("source", "")
+        page = chunk.page or chunk.metadata.get("page", "")
 
         if not source or not page:
             continue
 
-        # Clean source name
+        # Clean source name and page once per chunk
         source_name = source.split("/")[-1].replace(".pdf", "").lower()
+        page_text = str(page)
+
+        source_name_lines = lines_by_source.get(source_name)
+        if source_name_lines is None:
+            source_name_lines = [line for line in source_lines if source_name in line]
+            lines_by_source[source_name] = source_name_lines
 
         # Check if this chunk was cited
-        for line in source_lines:
-            if source_name in line and str(page) in line:
-                actually_used.append(chunk)
-                break
+        if any(page_text in line for line in source_name_lines):
+            actually_used.append(chunk)
 
     return actually_used
 
@@ -88,11 +127,7 @@ def estimate_tokens(text: str) -> int:
     return len(text) // 4
 
 ################################################################################
-import re
-
+# Removes the "Status:" line from the final answer shown to the user
+# Called by: API.answer_question when the answer is complete
 def remove_status_from_answer(answer: str) -> str:
-    return re.sub(
-        r"(?im)^status:\s*.*$",
-        "",
-        answer
-    ).strip()
+    return _STATUS_RE.sub("", answer).strip()